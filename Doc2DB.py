@@ -1,17 +1,42 @@
 import os
 import time
+import queue
 import threading
 import logging
+import hashlib
+import bisect
+import functools
+import itertools
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from pymilvus import connections, Collection, FieldSchema, CollectionSchema, DataType, utility
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from docx import Document
-from PyPDF2 import PdfFileReader
+from pypdf import PdfReader
+import tiktoken
+import diskcache
+import numpy as np
 
 # 配置日志记录
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# 复用HTTP连接池，避免每次请求Ollama都重新建立TCP连接
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=3, backoff_factor=0.2)))
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=3, backoff_factor=0.2)))
+
+# 文段整理使用的LLM；Ollama 的 qwen2:72b 默认即为 4-bit 量化（q4_0）版本
+LLM_MODEL = "qwen2:72b"
+
+# 切分文段使用的分词器，首次使用时才加载；离线环境可通过 TIKTOKEN_CACHE_DIR 指定预先下载的词表目录
+@functools.lru_cache(maxsize=1)
+def get_encoding():
+    return tiktoken.get_encoding("cl100k_base")
+
 # 配置Milvus数据库连接
 def connect_to_milvus(host='localhost', port='19530', collection_name='VectorRAGDB'):
     try:
@@ -33,12 +58,24 @@ def connect_to_milvus(host='localhost', port='19530', collection_name='VectorRAG
             collection = Collection(name=collection_name)
             logging.info(f"Using existing collection: {collection_name}")
         
+        # 嵌入向量写入前已归一化，内积即余弦相似度，与检索端的 IP 度量保持一致
         index_params = {
-            "index_type": "IVF_FLAT",
-            "params": {"nlist": 100},
-            "metric_type": "L2"
+            "index_type": "HNSW",
+            "params": {"M": 16, "efConstruction": 200},
+            "metric_type": "IP"
         }
-        collection.create_index(field_name="embeddings", index_params=index_params)
+        # 旧版本创建的索引类型或度量不一致时，删除后重建
+        if collection.has_index():
+            current_params = collection.index().params
+            if current_params.get("index_type") != index_params["index_type"] or current_params.get("metric_type") != index_params["metric_type"]:
+                logging.info(f"Rebuilding index on {collection_name}: {current_params} -> {index_params}")
+                # 旧数据写入时未归一化，IP 检索会按向量长度而非余弦相似度排序，需要重新导入
+                logging.warning(f"Existing rows in {collection_name} were stored without normalization; drop the collection and re-ingest the files for correct IP ranking")
+                collection.release()
+                collection.drop_index()
+        # 已存在索引时跳过创建，避免每次启动多一次RPC
+        if not collection.has_index():
+            collection.create_index(field_name="embeddings", index_params=index_params)
         collection.load()
         
         return collection
@@ -47,7 +84,7 @@ def connect_to_milvus(host='localhost', port='19530', collection_name='VectorRAG
         return None
 
 # LLM总结优化，prompt修改第一行就行，其他的会自动同步
-def summarize_text_with_llm(text, llm_model="qwen2:72b", base_url="http://localhost:11434", prompt="以下文段是将要录入RAG系统知识库的文段，请将文段中的所有内容整理一下，整理后的内容需要包含原文段的所有信息，不要出现丢失或者混淆，回答只包含处理过的文段内容，不要返回任何无关的其他文字或语句"):
+def summarize_text_with_llm(text, llm_model=LLM_MODEL, base_url="http://localhost:11434", prompt="以下文段是将要录入RAG系统知识库的文段，请将文段中的所有内容整理一下，整理后的内容需要包含原文段的所有信息，不要出现丢失或者混淆，回答只包含处理过的文段内容，不要返回任何无关的其他文字或语句"):
     try:
         json_input = {
             "model": llm_model,
@@ -57,7 +94,7 @@ def summarize_text_with_llm(text, llm_model="qwen2:72b", base_url="http://localh
             ],
             "stream": False
         }
-        response = requests.post(
+        response = SESSION.post(
             url=f"{base_url}/v1/chat/completions",
             json=json_input
         )
@@ -69,24 +106,148 @@ def summarize_text_with_llm(text, llm_model="qwen2:72b", base_url="http://localh
         logging.error(f"Error summarizing text with LLM: {e}")
         return text
 
-# 生成嵌入向量
-def generate_embedding(text, embedding_model="theepicdev/nomic-embed-text:v1.5-q6_K", base_url="http://localhost:11434"):
+# 估算文段中的噪声比例：重复行、过短行以及以符号为主的行
+def _boilerplate_ratio(text):
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    if not lines:
+        return 1.0
+    seen = set()
+    noisy = 0
+    for line in lines:
+        word_chars = sum(ch.isalnum() for ch in line)
+        if line in seen or len(line) < 5 or word_chars < len(line) / 2:
+            noisy += 1
+        seen.add(line)
+    return noisy / len(lines)
+
+def _low_boilerplate(text, threshold=0.1):
+    return _boilerplate_ratio(text) < threshold
+
+# 整理结果与嵌入向量的持久化缓存，以模型名和文段内容的SHA-256为键，跨文件、跨进程复用
+CACHE = diskcache.Cache("./.ragcache")
+
+def _cache_key(model, text):
+    return hashlib.sha256((model + text).encode("utf-8")).hexdigest()
+
+# 仅对较长且噪声较多的文段调用LLM整理，其余直接使用原文
+# min_tokens 以 cl100k token 计，与 split_text 的窗口单位一致
+def summarize_segment(segment, prompt, min_tokens=200, llm_model=LLM_MODEL):
+    if len(get_encoding().encode(segment)) < min_tokens or _low_boilerplate(segment):
+        return segment
+
+    key = _cache_key(llm_model, prompt + segment)
+    summarized_segment = CACHE.get(key)
+    if summarized_segment is not None:
+        return summarized_segment
+
+    summarized_segment = summarize_text_with_llm(segment, llm_model=llm_model, prompt=prompt)
+    # 调用失败时返回的是原文，不写入缓存
+    if summarized_segment != segment:
+        CACHE[key] = summarized_segment
+    return summarized_segment
+
+# 按行做L2归一化，全零行保持不变
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return matrix / np.where(norms > 0, norms, 1)
+
+# 批量生成嵌入向量，一次请求处理一批文段（Ollama /api/embed 支持列表输入）
+def generate_embeddings(texts, embedding_model="theepicdev/nomic-embed-text:v1.5-q6_K", base_url="http://localhost:11434"):
     try:
-        json_input = {"model": embedding_model, "prompt": text}
-        response = requests.post(
-            url=f"{base_url}/api/embeddings",
+        # 命中缓存的文段不再请求，只对缺失部分发起一次批量请求
+        keys = [_cache_key(embedding_model, text) for text in texts]
+        embeddings = [CACHE.get(key) for key in keys]
+        embeddings = [None if embedding is None else np.asarray(embedding, dtype=np.float32) for embedding in embeddings]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if not missing:
+            return _normalize(np.stack(embeddings))
+
+        json_input = {"model": embedding_model, "input": [texts[i] for i in missing]}
+        response = SESSION.post(
+            url=f"{base_url}/api/embed",
             json=json_input
         )
-        logging.debug(f"Embedding Request Body: {json_input}")
+        logging.debug(f"Batch Embedding Request Size: {len(missing)} (cached: {len(texts) - len(missing)})")
         response.raise_for_status()
-        embedding = response.json().get("embedding", [])
-        return embedding
+        new_embeddings = response.json().get("embeddings", [])
+        if len(new_embeddings) != len(missing):
+            logging.error(f"Embedding count mismatch: expected {len(missing)}, got {len(new_embeddings)}")
+            return []
+
+        for i, embedding in zip(missing, new_embeddings):
+            embedding = np.asarray(embedding, dtype=np.float32)
+            embeddings[i] = embedding
+            CACHE[keys[i]] = embedding
+        # 以归一化后的 (N, D) float32 矩阵返回，直接用于批量写入
+        return _normalize(np.stack(embeddings))
     except requests.exceptions.RequestException as e:
-        logging.error(f"Error generating embedding: {e}")
+        logging.error(f"Error generating embeddings: {e}")
         return []
 
+# 提取PDF指定页码范围的文本，在子进程中执行
+def _extract_pdf_pages(args):
+    file_path, start, end = args
+    reader = PdfReader(file_path)
+    return [reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+# PDF文本提取使用的进程池，在 __main__ 中创建并在所有文件间共享；未创建时串行提取
+PDF_POOL = None
+
+# 多进程并行提取PDF文本，每个进程负责一段连续页码；页数较少时直接串行提取
+def extract_pdf_text(file_path, min_parallel_pages=32):
+    reader = PdfReader(file_path)
+    page_count = len(reader.pages)
+    if page_count == 0:
+        return ""
+
+    if PDF_POOL is None or page_count < min_parallel_pages:
+        return "\n".join(page.extract_text() or "" for page in reader.pages)
+
+    workers = min(os.cpu_count() or 1, page_count)
+    step = -(-page_count // workers)
+    ranges = [(file_path, start, min(start + step, page_count)) for start in range(0, page_count, step)]
+
+    pages = [page for chunk in PDF_POOL.map(_extract_pdf_pages, ranges) for page in chunk]
+    return "\n".join(pages)
+
+# 按token切分文本，相邻文段保留少量重叠，并尽量在句末或换行处断开
+# 窗口的起止位置都对齐到字符边界后直接截取原文，避免多字节字符被拆开
+def split_text(text, segment_tokens=400, overlap_tokens=40, boundaries="。！？\n"):
+    encoding = get_encoding()
+    tokens = encoding.encode(text)
+    if not tokens:
+        return []
+
+    # 每个token结束处的字节偏移，以及每个字符起始处的字节偏移
+    token_ends = list(itertools.accumulate(len(encoding.decode_single_token_bytes(token)) for token in tokens))
+    char_starts = list(itertools.accumulate((len(ch.encode("utf-8")) for ch in text), initial=0))
+
+    # 前 token_count 个token之后的位置，向后对齐到完整字符
+    def to_char(token_count):
+        byte_offset = token_ends[token_count - 1] if token_count > 0 else 0
+        return bisect.bisect_left(char_starts, byte_offset)
+
+    segments = []
+    start = 0
+    while start < len(tokens):
+        end = min(start + segment_tokens, len(tokens))
+        char_start, char_end = to_char(start), to_char(end)
+
+        if end < len(tokens):
+            cut = max(text.rfind(ch, char_start, char_end) for ch in boundaries)
+            # 断点太靠前时保持原窗口，避免产生过短的文段
+            if cut >= char_start + (char_end - char_start) // 2:
+                char_end = cut + 1
+                end = bisect.bisect_right(token_ends, char_starts[char_end])
+
+        segments.append(text[char_start:char_end])
+        if end >= len(tokens):
+            break
+        start = max(end - overlap_tokens, start + 1)
+    return segments
+
 # 文件处理
-def process_file(file_path, segment_length=2000, prompt="优化以下文段内容，去除无效信息", collection=None):
+def process_file(file_path, segment_tokens=400, prompt="优化以下文段内容，去除无效信息", collection=None, max_workers=8, insert_batch_size=1000, overlap_tokens=40, min_summarize_ratio=0.5, embed_batch_size=64):
     ext = os.path.splitext(file_path)[1].lower()
 
     try:
@@ -97,50 +258,115 @@ def process_file(file_path, segment_length=2000, prompt="优化以下文段内
             doc = Document(file_path)
             text = "\n".join([para.text for para in doc.paragraphs])
         elif ext == ".pdf":
-            pdf = PdfFileReader(open(file_path, "rb"))
-            text = "\n".join([page.extract_text() for page in pdf.pages])
+            text = extract_pdf_text(file_path)
         else:
             logging.warning(f"Unsupported file format: {ext}")
             return
 
-        segments = [text[i:i + segment_length] for i in range(0, len(text), segment_length)]
+        segments = split_text(text, segment_tokens, overlap_tokens)
+        segments = [segment for segment in segments if len(segment.strip()) > 0]
+        if not segments:
+            logging.warning(f"No text extracted from file: {file_path}")
+            return
 
-        for segment in segments:
-            if len(segment.strip()) == 0:
+        # 并发调用LLM整理文段，保持原有顺序；不足 segment_tokens * min_summarize_ratio 个token的文段不整理
+        min_summarize_tokens = int(segment_tokens * min_summarize_ratio)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            summarized_segments = list(executor.map(lambda segment: summarize_segment(segment, prompt, min_summarize_tokens), segments))
+
+        # 分批生成嵌入向量，单批失败只跳过该批文段，不影响文件中的其他文段
+        embedding_batches = []
+        embedded_segments = []
+        for i in range(0, len(summarized_segments), embed_batch_size):
+            batch_segments = summarized_segments[i:i + embed_batch_size]
+            batch_embeddings = generate_embeddings(batch_segments)
+            if len(batch_embeddings) == 0:
+                logging.warning(f"Failed to generate valid embeddings for segments {i}-{i + len(batch_segments) - 1} of file: {file_path}")
                 continue
+            embedding_batches.append(batch_embeddings)
+            embedded_segments.extend(batch_segments)
 
-            summarized_segment = summarize_text_with_llm(segment, prompt=prompt)
-            embedding = generate_embedding(summarized_segment)
+        if not embedded_segments:
+            logging.warning(f"Failed to generate valid embeddings for file: {file_path}")
+            return
+        embeddings = np.concatenate(embedding_batches)
 
-            if embedding and isinstance(embedding, list):
-                try:
-                    data_to_insert = [[embedding], [summarized_segment]]
-                    collection.insert(data_to_insert)
-                    logging.info(f"Successfully inserted segment: {summarized_segment[:50]}")
-                except Exception as e:
-                    logging.error(f"Error inserting data into Milvus: {e}")
-            else:
-                logging.warning(f"Failed to generate valid embedding for segment: {summarized_segment[:50]}")
+        # 分批写入Milvus，避免单次请求过大或代理任务队列堆积
+        try:
+            for i in range(0, len(embeddings), insert_batch_size):
+                collection.insert([embeddings[i:i + insert_batch_size], embedded_segments[i:i + insert_batch_size]])
+            collection.flush()
+            logging.info(f"Successfully inserted {len(embedded_segments)}/{len(summarized_segments)} segments from file: {file_path}")
+        except Exception as e:
+            logging.error(f"Error inserting data into Milvus: {e}")
 
     except Exception as e:
         logging.error(f"Error processing file {file_path}: {e}")
 
 # 文件系统事件处理
 class FileHandler(FileSystemEventHandler):
-    def __init__(self, collection):
+    def __init__(self, collection, batch_size=8, batch_wait=0.2, max_workers=4):
         self.collection = collection
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.max_workers = max_workers
+        self.queue = queue.Queue()
+
+        # 后台线程消费文件队列，不阻塞watchdog的事件线程
+        self.worker = threading.Thread(target=self._consume, daemon=True)
+        self.worker.start()
     
     def on_created(self, event):
         if not event.is_directory and event.src_path.lower().endswith(('.txt', '.doc', '.docx', '.pdf')):
             logging.info(f"New file detected: {event.src_path}")
-            file_size = 0
-            while file_size == 0:
-                file_size = os.path.getsize(event.src_path)
-                if file_size == 0:
-                    logging.info(f"Waiting for file to be written: {event.src_path}")
-                    time.sleep(1)
-            
-            process_file(event.src_path, 2000, "优化以下文段内容，去除无效信息", self.collection)
+            self.queue.put(event.src_path)
+
+    # 取出一批文件：阻塞等待第一个，之后最多等待batch_wait秒或凑满batch_size个
+    def _drain(self):
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return list(dict.fromkeys(batch))
+
+    # 连续两次读取到相同且非零的文件大小，才认为文件已写入完成
+    def _wait_until_stable(self, file_path, interval=1):
+        last_size = -1
+        while True:
+            try:
+                file_size = os.stat(file_path).st_size
+            except FileNotFoundError:
+                logging.warning(f"File disappeared before processing: {file_path}")
+                return False
+            except OSError as e:
+                logging.error(f"Cannot access file {file_path}: {e}")
+                return False
+            if file_size > 0 and file_size == last_size:
+                return True
+            logging.info(f"Waiting for file to be written: {file_path}")
+            last_size = file_size
+            time.sleep(interval)
+
+    # 单个文件的任何异常都在此处记录，避免中断唯一的消费线程
+    def _process(self, file_path):
+        try:
+            if self._wait_until_stable(file_path):
+                process_file(file_path, 400, "优化以下文段内容，去除无效信息", self.collection)
+        except Exception as e:
+            logging.error(f"Error processing file {file_path}: {e}")
+
+    def _consume(self):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                batch = self._drain()
+                logging.info(f"Processing batch of {len(batch)} files")
+                list(executor.map(self._process, batch))
 
 # 监视目录
 def monitor_directory(directory, collection):
@@ -162,7 +388,12 @@ if __name__ == "__main__":
     collection = connect_to_milvus()
 
     if collection:
+        # 主进程中已有watchdog和工作线程，子进程使用 spawn 启动，避免 fork 继承锁导致死锁
+        PDF_POOL = ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn"))
         directory_to_watch = "/PATH/TO/YOUR/FILE"#修改为储存txt，pdf,doc文件夹
-        monitor_directory(directory_to_watch, collection)
+        try:
+            monitor_directory(directory_to_watch, collection)
+        finally:
+            PDF_POOL.shutdown()
     else:
         logging.error("Failed to connect to Milvus or create the collection.")
@@ -1,9 +1,29 @@
 from typing import List, Union, Generator, Iterator
 from pydantic import BaseModel
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pymilvus import connections, Collection
 from schemas import OpenAIChatMessage
 
+# 复用HTTP连接池，避免每次请求Ollama都重新建立TCP连接
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=3, backoff_factor=0.2)))
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=3, backoff_factor=0.2)))
+
+# 模块级缓存Milvus连接与Collection句柄，Pipeline重复实例化时直接复用
+_COLLECTIONS = {}
+
+def get_milvus_collection(host: str, port: str, collection_name: str) -> Collection:
+    if not connections.has_connection("default"):
+        connections.connect(alias="default", host=host, port=port)
+    if collection_name not in _COLLECTIONS:
+        collection = Collection(collection_name)
+        collection.load()
+        _COLLECTIONS[collection_name] = collection
+    return _COLLECTIONS[collection_name]
+
 
 class Pipeline:
     class Valves(BaseModel):
@@ -11,9 +31,13 @@ class Pipeline:
         MILVUS_PORT: str
         COLLECTION_NAME: str
         OLLAMA_HOST: str
+        LLM_HOST: str  # OpenAI 兼容的生成服务地址，可指向支持连续批处理的 vLLM 等推理服务
         EMBEDDING_MODEL: str
+        EMBED_DIM: int  # 嵌入向量维度，需与 Collection 的 schema 一致
         LLM_MODEL: str
         PROMPT: str  # 新增自定义 prompt 字段
+        RERANK_CANDIDATES: int  # 先从 Milvus 取回的候选数，在本地做 MMR 重排；0 表示不重排
+        EMBEDDING_CACHE_PATH: str  # 重排使用的本地向量矩阵文件（memmap）
 
     def __init__(self):
         self.name = "Ollama Vector Database Pipeline"
@@ -24,56 +48,129 @@ class Pipeline:
             MILVUS_PORT="19530",
             COLLECTION_NAME="RAGDB",
             OLLAMA_HOST="http://localhost:11434",
+            LLM_HOST="http://localhost:11434",
             EMBEDDING_MODEL="theepicdev/nomic-embed-text:v1.5-q6_K",
+            EMBED_DIM=768,
             LLM_MODEL="qwen2:72b",
-            PROMPT="你是一个知识丰富的助手，能够回答各种问题。"  # 默认的自定义 prompt
+            PROMPT="你是一个知识丰富的助手，能够回答各种问题。",  # 默认的自定义 prompt
+            RERANK_CANDIDATES=0,
+            EMBEDDING_CACHE_PATH="emb.f32"
         )
         
+        self.embedding_ids = None
+        self.embedding_matrix = None
         self.connect_to_milvus()
 
     async def on_startup(self):
-        pass
+        if self.valves.RERANK_CANDIDATES > 0:
+            self.load_embedding_matrix()
 
     async def on_shutdown(self):
         pass
 
     def connect_to_milvus(self):
-        connections.connect(alias="default", host=self.valves.MILVUS_HOST, port=self.valves.MILVUS_PORT)
-        self.collection = Collection(self.valves.COLLECTION_NAME)
+        self.collection = get_milvus_collection(self.valves.MILVUS_HOST, self.valves.MILVUS_PORT, self.valves.COLLECTION_NAME)
+
+    def load_embedding_matrix(self):
+        # 将 Collection 中的向量导出为按主键排序的 (N, D) float32 矩阵并写入 memmap，仅适用于小规模 Collection
+        # 导出失败时不启用重排，不影响正常检索
+        try:
+            rows = self.collection.query(expr="id >= 0", output_fields=["id", "embeddings"])
+            if not rows:
+                return
+            rows.sort(key=lambda row: row["id"])
+
+            matrix = np.memmap(self.valves.EMBEDDING_CACHE_PATH, dtype=np.float32, mode="w+", shape=(len(rows), self.valves.EMBED_DIM))
+            matrix[:] = np.asarray([row["embeddings"] for row in rows], dtype=np.float32)
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            matrix /= np.where(norms > 0, norms, 1)
+            matrix.flush()
+
+            self.embedding_ids = np.fromiter((row["id"] for row in rows), dtype=np.int64, count=len(rows))
+            self.embedding_matrix = np.memmap(self.valves.EMBEDDING_CACHE_PATH, dtype=np.float32, mode="r", shape=matrix.shape)
+            print(f"已加载 {len(rows)} 条向量用于重排")
+        except Exception as e:
+            print(f"加载重排向量失败，不启用重排: {e}")
+            self.embedding_ids = None
+            self.embedding_matrix = None
+
+    def rerank(self, candidate_ids: List[int], candidate_scores: List[float], candidate_texts: List[str], top_k: int, mmr_lambda: float = 0.7) -> List[str]:
+        # MMR 重排：相关性使用 Milvus 返回的内积得分，候选之间的相似度通过一次矩阵乘法得到
+        if self.embedding_matrix is None:
+            return candidate_texts[:top_k]
+
+        top_k = min(top_k, len(candidate_texts))
+        if top_k == 0:
+            return []
+
+        candidate_ids = np.asarray(candidate_ids, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.embedding_ids, candidate_ids), len(self.embedding_ids) - 1)
+        # 启动后新写入的数据不在矩阵中：保留这些候选，只是不参与相似度惩罚
+        known = self.embedding_ids[rows] == candidate_ids
+
+        relevance = np.asarray(candidate_scores, dtype=np.float32)
+        similarity = np.zeros((len(candidate_ids), len(candidate_ids)), dtype=np.float32)
+        if known.any():
+            vectors = self.embedding_matrix[rows[known]]
+            similarity[np.ix_(known, known)] = vectors @ vectors.T
+
+        selected = [int(np.argmax(relevance))]
+        max_similarity = similarity[selected[0]].copy()
+        while len(selected) < top_k:
+            scores = mmr_lambda * relevance - (1 - mmr_lambda) * max_similarity
+            scores[selected] = -np.inf
+            best = int(np.argmax(scores))
+            selected.append(best)
+            max_similarity = np.maximum(max_similarity, similarity[best])
+        return [candidate_texts[i] for i in selected]
     
-    def generate_embedding(self, text: str) -> List[float]:
+    def generate_embedding(self, text: str) -> np.ndarray:
         try:
-            response = requests.post(
+            response = SESSION.post(
                 url=f"{self.valves.OLLAMA_HOST}/api/embeddings",
                 json={"model": self.valves.EMBEDDING_MODEL, "prompt": text}
             )
 
             response.raise_for_status()
-            embedding = response.json().get("embedding", [])
+            # 统一转换为 float32 数组，后续检索直接传给 pymilvus
+            embedding = np.asarray(response.json().get("embedding", []), dtype=np.float32)
             return embedding
         
         except Exception as e:
             print(f"生成嵌入时出错: {e}")
-            return [0.0] * 512
+            return np.zeros(self.valves.EMBED_DIM, dtype=np.float32)
+
+    def is_valid_vector(self, vector: np.ndarray) -> bool:
+        # 维度不符或全零向量（嵌入失败时的回退值）不发起检索，避免无效的 Milvus 请求
+        if len(vector) != self.valves.EMBED_DIM:
+            print(f"嵌入向量维度错误: {len(vector)}，预期为{self.valves.EMBED_DIM}维")
+            return False
+        return bool(np.any(vector))
 
     def retrieve_relevant_information(self, user_message: str) -> List[str]:
         user_vector = self.generate_embedding(user_message)
+        if not self.is_valid_vector(user_vector):
+            return []
+        user_vector = user_vector / np.linalg.norm(user_vector)  # 与入库向量一样归一化，内积即余弦相似度
         
-        search_params = {"metric_type": "L2", "params": {"nprobe": 10}}
+        # 启用重排时先取回更多候选
+        limit = max(self.valves.RERANK_CANDIDATES, 5) if self.embedding_matrix is not None else 5
+        search_params = {"metric_type": "IP", "params": {"ef": max(64, limit)}}
         results = self.collection.search(
             data=[user_vector],
             anns_field="embeddings",
             param=search_params,
-            limit=5,
+            limit=limit,
             output_fields=["text_segment"]
         )
         print(f"Milvus 检索结果: {results}")
         retrieved_contexts = [result.entity.get("text_segment") for result in results[0]]
+        if self.embedding_matrix is not None:
+            retrieved_contexts = self.rerank([result.id for result in results[0]], [result.distance for result in results[0]], retrieved_contexts, top_k=5)
         return retrieved_contexts
 
     def combine_user_message_with_context(self, user_message: str, contexts: List[str]) -> str:
-        # 使用 valves 中的 prompt 作为开头
-        combined_message = self.valves.PROMPT + "\n\n" + user_message + "\n\n" + "\n".join(contexts)
+        combined_message = user_message + "\n\n" + "\n".join(contexts)
         return combined_message
     
     def pipe(self, user_message: str, model_id: str, messages: List[dict], body: dict) -> Union[str, Generator, Iterator]:
@@ -85,6 +182,8 @@ class Pipeline:
         retrieved_contexts = self.retrieve_relevant_information(user_message)
         combined_message = self.combine_user_message_with_context(user_message, retrieved_contexts)
         
+        # valves 中的 prompt 固定作为 system 消息放在最前面，保持请求前缀不变以复用模型的 KV 缓存
+        body['messages'].append({"role": "system", "content": self.valves.PROMPT})
         # 添加当前用户消息到 body['messages']
         body['messages'].append({"role": "user", "content": combined_message})
         
@@ -95,8 +194,8 @@ class Pipeline:
             print("######################################")
         
         try:
-            r = requests.post(
-                url=f"{self.valves.OLLAMA_HOST}/v1/chat/completions",
+            r = SESSION.post(
+                url=f"{self.valves.LLM_HOST}/v1/chat/completions",
                 json={**body, "model": self.valves.LLM_MODEL},
                 stream=True,
             )
@@ -1,9 +1,30 @@
 from typing import List, Union, Generator, Iterator
+from concurrent.futures import ThreadPoolExecutor
 from pydantic import BaseModel
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pymilvus import connections, Collection
 from schemas import OpenAIChatMessage
 
+# 复用HTTP连接池，避免每次请求Ollama都重新建立TCP连接
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=3, backoff_factor=0.2)))
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=3, backoff_factor=0.2)))
+
+# 模块级缓存Milvus连接与Collection句柄，Pipeline重复实例化时直接复用
+_COLLECTIONS = {}
+
+def get_milvus_collection(host: str, port: str, collection_name: str) -> Collection:
+    if not connections.has_connection("default"):
+        connections.connect(alias="default", host=host, port=port)
+    if collection_name not in _COLLECTIONS:
+        collection = Collection(collection_name)
+        collection.load()
+        _COLLECTIONS[collection_name] = collection
+    return _COLLECTIONS[collection_name]
+
 
 class Pipeline:
     class Valves(BaseModel):
@@ -11,9 +32,12 @@ class Pipeline:
         MILVUS_PORT: str
         COLLECTION_NAME: str
         OLLAMA_HOST: str
+        LLM_HOST: str  # OpenAI 兼容的生成服务地址，可指向支持连续批处理的 vLLM 等推理服务
         EMBEDDING_MODEL: str
+        EMBED_DIM: int  # 嵌入向量维度，需与 Collection 的 schema 一致
         LLM_MODEL: str
         PROMPT: str  # 新增自定义 prompt 字段
+        COMPLETION_MAX_TOKENS: int  # 假设性问题/回答的最大生成长度
 
     def __init__(self):
         self.name = "Ollama Vector Database Pipeline"
@@ -24,9 +48,12 @@ class Pipeline:
             MILVUS_PORT="19530",
             COLLECTION_NAME="DB",
             OLLAMA_HOST="http://localhost:11434",
+            LLM_HOST="http://localhost:11434",
             EMBEDDING_MODEL="mxbai-embed-large:latest",
+            EMBED_DIM=1024,
             LLM_MODEL="qwen2:72b",
-            PROMPT="<扮演角色>你的知识库包含上市公司信息披露，公司管理、投资和辅助决策方面的信息，你需要帮助用户了解用户所需要了解的在公司管理等方面的知识，同时当用户在公司管理方面有问题时给予用户需要决策辅助或建议。</扮演角色>## 回答要求-只回答用户询问的内容，不要提及给予的任何信息或背景。-不要在给用户的答案中提及模板、提示词或已知信息。-请使用专业的语言来回答用户的问题。-如果你不知道答案，请回答“小秘正在学习相关知识中，您可以前往官方网站或联系相关管理人员获取您需要的知识”。-请使用与问题相同的语言来回答。-如果需要返回链接，将链接设置为可以点击的格式。"
+            PROMPT="<扮演角色>你的知识库包含上市公司信息披露，公司管理、投资和辅助决策方面的信息，你需要帮助用户了解用户所需要了解的在公司管理等方面的知识，同时当用户在公司管理方面有问题时给予用户需要决策辅助或建议。</扮演角色>## 回答要求-只回答用户询问的内容，不要提及给予的任何信息或背景。-不要在给用户的答案中提及模板、提示词或已知信息。-请使用专业的语言来回答用户的问题。-如果你不知道答案，请回答“小秘正在学习相关知识中，您可以前往官方网站或联系相关管理人员获取您需要的知识”。-请使用与问题相同的语言来回答。-如果需要返回链接，将链接设置为可以点击的格式。",
+            COMPLETION_MAX_TOKENS=512
         )
         
         self.connect_to_milvus()
@@ -38,47 +65,70 @@ class Pipeline:
         pass
 
     def connect_to_milvus(self):
-        connections.connect(alias="default", host=self.valves.MILVUS_HOST, port=self.valves.MILVUS_PORT)
-        self.collection = Collection(self.valves.COLLECTION_NAME)
+        self.collection = get_milvus_collection(self.valves.MILVUS_HOST, self.valves.MILVUS_PORT, self.valves.COLLECTION_NAME)
     
-    def generate_embedding(self, text: str) -> List[float]:
+    def generate_embedding(self, text: str) -> np.ndarray:
         try:
-            response = requests.post(
+            response = SESSION.post(
                 url=f"{self.valves.OLLAMA_HOST}/api/embeddings",
-                json={"model": self.valves.EMBEDDING_MODEL, "prompt": text, "output_dim": 1024}
+                json={"model": self.valves.EMBEDDING_MODEL, "prompt": text, "output_dim": self.valves.EMBED_DIM}
             )
 
             response.raise_for_status()
-            embedding = response.json().get("embedding", [])
+            # 统一转换为 float32 数组，后续检索直接传给 pymilvus
+            embedding = np.asarray(response.json().get("embedding", []), dtype=np.float32)
             return embedding
         
         except Exception as e:
             print(f"生成嵌入时出错: {e}")
-            return [0.0] * 1024
+            return np.zeros(self.valves.EMBED_DIM, dtype=np.float32)
 
     def generate_hypothetical_question(self, text_block: str) -> str:
         # 使用LLM生成文本块的假设性问题
-        response = requests.post(
-            url=f"{self.valves.OLLAMA_HOST}/v1/completions",
+        response = SESSION.post(
+            url=f"{self.valves.LLM_HOST}/v1/completions",
             json={
                 "model": self.valves.LLM_MODEL,
-                "prompt": f"为以下文本块生成一个假设性问题：\n\n{text_block}"
+                "prompt": f"为以下文本块生成一个假设性问题：\n\n{text_block}",
+                "max_tokens": self.valves.COMPLETION_MAX_TOKENS  # OpenAI 兼容服务（如 vLLM）默认只生成 16 个 token
             }
         )
         response.raise_for_status()
         return response.json().get("choices", [{}])[0].get("text", "").strip()
 
+    def is_valid_vector(self, vector: np.ndarray) -> bool:
+        # 维度不符或全零向量（嵌入失败时的回退值）不发起检索，避免无效的 Milvus 请求
+        if len(vector) != self.valves.EMBED_DIM:
+            print(f"嵌入向量维度错误: {len(vector)}，预期为{self.valves.EMBED_DIM}维")
+            return False
+        return bool(np.any(vector))
+
     def retrieve_relevant_information(self, user_message: str) -> List[str]:
-        user_vector = self.generate_embedding(user_message)
-        
-        # HyDE 方法：生成一个假设性回答，并获取其向量
-        hypothetical_answer = self.generate_hypothetical_answer(user_message)
-        hypothetical_vector = self.generate_embedding(hypothetical_answer)
+        # 用户查询向量与假设性回答的生成互不依赖，并发执行
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            user_vector_future = executor.submit(self.generate_embedding, user_message)
+
+            # HyDE 方法：生成一个假设性回答，并获取其向量
+            hypothetical_answer = self.generate_hypothetical_answer(user_message)
+            hypothetical_vector_future = executor.submit(self.generate_embedding, hypothetical_answer)
+
+            user_vector = user_vector_future.result()
+            hypothetical_vector = hypothetical_vector_future.result()
+
+        # 任一向量无效时仅使用另一个向量检索，两者都无效则不发起检索
+        vectors = [vector / np.linalg.norm(vector) for vector in (user_vector, hypothetical_vector) if self.is_valid_vector(vector)]
+        if not vectors:
+            return []
+
+        # 使用HyDE方法和用户查询向量的组合进行检索：两者分别归一化后相加，再归一化为单个查询向量
+        fused_vector = np.sum(vectors, axis=0)
+        norm = np.linalg.norm(fused_vector)
+        if norm > 0:
+            fused_vector /= norm
 
-        # 使用HyDE方法和用户查询向量的组合进行检索
-        search_params = {"metric_type": "IP", "params": {"nprobe": 10}}
+        search_params = {"metric_type": "IP", "params": {"ef": 64}}
         results = self.collection.search(
-            data=[user_vector, hypothetical_vector],  # 同时使用用户查询和假设性回答向量
+            data=[fused_vector],
             anns_field="embeddings",
             param=search_params,
             limit=5,
@@ -90,19 +140,19 @@ class Pipeline:
 
     def generate_hypothetical_answer(self, user_message: str) -> str:
         # 根据用户查询生成一个假设性回答
-        response = requests.post(
-            url=f"{self.valves.OLLAMA_HOST}/v1/completions",
+        response = SESSION.post(
+            url=f"{self.valves.LLM_HOST}/v1/completions",
             json={
                 "model": self.valves.LLM_MODEL,
-                "prompt": f"基于以下问题生成一个假设性回答：\n\n{user_message}"
+                "prompt": f"基于以下问题生成一个假设性回答：\n\n{user_message}",
+                "max_tokens": self.valves.COMPLETION_MAX_TOKENS  # OpenAI 兼容服务（如 vLLM）默认只生成 16 个 token
             }
         )
         response.raise_for_status()
         return response.json().get("choices", [{}])[0].get("text", "").strip()
 
     def combine_user_message_with_context(self, user_message: str, contexts: List[str]) -> str:
-        # 使用 valves 中的 prompt 作为开头
-        combined_message = self.valves.PROMPT + "\n\n" + "这是用户问题：" + "\n\n"  + user_message + "\n\n" + "这是你学习的内容，回答时请不要提及从此获取的信息：" + "\n".join(contexts)
+        combined_message = "这是用户问题：" + "\n\n"  + user_message + "\n\n" + "这是你学习的内容，回答时请不要提及从此获取的信息：" + "\n".join(contexts)
         return combined_message
     
     def pipe(self, user_message: str, model_id: str, messages: List[dict], body: dict) -> Union[str, Generator, Iterator]:
@@ -114,6 +164,8 @@ class Pipeline:
         retrieved_contexts = self.retrieve_relevant_information(user_message)
         combined_message = self.combine_user_message_with_context(user_message, retrieved_contexts)
         
+        # valves 中的 prompt 固定作为 system 消息放在最前面，保持请求前缀不变以复用模型的 KV 缓存
+        body['messages'].append({"role": "system", "content": self.valves.PROMPT})
         # 添加当前用户消息到 body['messages']
         body['messages'].append({"role": "user", "content": combined_message})
         
@@ -124,8 +176,8 @@ class Pipeline:
             print("######################################")
         
         try:
-            r = requests.post(
-                url=f"{self.valves.OLLAMA_HOST}/v1/chat/completions",
+            r = SESSION.post(
+                url=f"{self.valves.LLM_HOST}/v1/chat/completions",
                 json={**body, "model": self.valves.LLM_MODEL},
                 stream=True,
             )
@@ -1,8 +1,29 @@
 from typing import List, Union, Generator, Iterator
 from pydantic import BaseModel
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from pymilvus import connections, Collection
-import json
+import orjson
+import hashlib
+
+# 复用HTTP连接池，避免每次请求Ollama都重新建立TCP连接
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=3, backoff_factor=0.2)))
+SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=Retry(total=3, backoff_factor=0.2)))
+
+# 模块级缓存Milvus连接与Collection句柄，Pipeline重复实例化时直接复用
+_COLLECTIONS = {}
+
+def get_milvus_collection(host: str, port: str, collection_name: str) -> Collection:
+    if not connections.has_connection("default"):
+        connections.connect(alias="default", host=host, port=port)
+    if collection_name not in _COLLECTIONS:
+        collection = Collection(collection_name)
+        collection.load()
+        _COLLECTIONS[collection_name] = collection
+    return _COLLECTIONS[collection_name]
 
 class Pipeline:
     class Valves(BaseModel):
@@ -10,10 +31,14 @@ class Pipeline:
         MILVUS_PORT: str
         COLLECTION_NAME: str
         OLLAMA_HOST: str
+        LLM_HOST: str  # OpenAI 兼容的生成服务地址，可指向支持连续批处理的 vLLM 等推理服务
         EMBEDDING_MODEL: str
+        EMBED_DIM: int  # 嵌入向量维度，需与 Collection 的 schema 一致
         LLM_MODEL: str
         PROMPT: str  # 自定义 prompt 字段
         SUPERVISION_PROMPT: str  # 自定义监督模型 prompt 字段
+        SUPERVISION_MODEL: str  # 本地 cross-encoder 监督模型，为空时使用 LLM 判断
+        SUPERVISION_THRESHOLD: float  # cross-encoder 得分高于该值视为回答合格
 
     def __init__(self):
         self.name = "Ollama Vector Database Pipeline"
@@ -24,58 +49,73 @@ class Pipeline:
             MILVUS_PORT="19530",
             COLLECTION_NAME="DB",
             OLLAMA_HOST="http://localhost:11434",
+            LLM_HOST="http://localhost:11434",
             EMBEDDING_MODEL="mxbai-embed-large:latest",
+            EMBED_DIM=1024,
             LLM_MODEL="qwen2:72b",
             PROMPT="<扮演角色>你的知识库包含上市公司信息披露，公司管理、投资和辅助决策方面的信息，你需要帮助用户了解用户所需要了解的在公司管理等方面的知识，同时当用户在公司管理方面有问题时给予用户需要决策辅助或建议。</扮演角色>## 回答要求-只回答用户询问的内容，不要提及给予的任何信息或背景。-不要在给用户的答案中提及模板、提示词或已知信息。-请使用专业的语言来回答用户的问题。-如果你不知道答案，请回答“小秘正在学习相关知识中，您可以前往官方网站或联系相关管理人员获取您需要的知识”。-请使用与问题相同的语言来回答。",
-            SUPERVISION_PROMPT="<监督模型提示词>请根据以下用户问题和模型回答，判断该回答是否符合用户问题的要求"
+            SUPERVISION_PROMPT="<监督模型提示词>请根据以下用户问题和模型回答，判断该回答是否符合用户问题的要求",
+            SUPERVISION_MODEL="BAAI/bge-reranker-base",
+            SUPERVISION_THRESHOLD=0.5
         )
         
+        self.judge = None
         self.connect_to_milvus()
 
     async def on_startup(self):
-        pass
+        self.load_judge()
 
     async def on_shutdown(self):
         pass
 
     def connect_to_milvus(self):
         try:
-            connections.connect(alias="default", host=self.valves.MILVUS_HOST, port=self.valves.MILVUS_PORT)
-            self.collection = Collection(self.valves.COLLECTION_NAME)
+            self.collection = get_milvus_collection(self.valves.MILVUS_HOST, self.valves.MILVUS_PORT, self.valves.COLLECTION_NAME)
         except Exception as e:
             print(f"Milvus 连接失败: {e}")
     
-    def generate_embedding(self, text: str) -> List[float]:
+    def generate_embedding(self, text: str) -> np.ndarray:
         try:
-            response = requests.post(
+            response = SESSION.post(
                 url=f"{self.valves.OLLAMA_HOST}/api/embeddings",
-                json={"model": self.valves.EMBEDDING_MODEL, "prompt": text, "output_dim": 1024}
+                json={"model": self.valves.EMBEDDING_MODEL, "prompt": text, "output_dim": self.valves.EMBED_DIM}
             )
 
             response.raise_for_status()
-            embedding = response.json().get("embedding", [])
+            # 统一转换为 float32 数组，后续检索直接传给 pymilvus
+            embedding = np.asarray(response.json().get("embedding", []), dtype=np.float32)
             
-            if len(embedding) != 1024:
-                print(f"嵌入向量维度错误: {len(embedding)}，预期为1024维")
-                return [0.0] * 1024
+            if len(embedding) != self.valves.EMBED_DIM:
+                print(f"嵌入向量维度错误: {len(embedding)}，预期为{self.valves.EMBED_DIM}维")
+                return np.zeros(self.valves.EMBED_DIM, dtype=np.float32)
             
             return embedding
         
         except Exception as e:
             print(f"生成嵌入时出错: {e}")
-            return [0.0] * 1024
+            return np.zeros(self.valves.EMBED_DIM, dtype=np.float32)
+
+    def is_valid_vector(self, vector: np.ndarray) -> bool:
+        # 维度不符或全零向量（嵌入失败时的回退值）不发起检索，避免无效的 Milvus 请求
+        if len(vector) != self.valves.EMBED_DIM:
+            print(f"嵌入向量维度错误: {len(vector)}，预期为{self.valves.EMBED_DIM}维")
+            return False
+        return bool(np.any(vector))
 
-    def retrieve_relevant_information(self, user_message: str) -> List[str]:
+    def retrieve_relevant_information(self, user_message: str, limit: int = 10, ef: int = 64) -> List[str]:
         user_vector = self.generate_embedding(user_message)
+        if not self.is_valid_vector(user_vector):
+            return []
+        user_vector = user_vector / np.linalg.norm(user_vector)  # 与入库向量一样归一化，内积即余弦相似度
 
-        search_params = {"metric_type": "IP", "params": {"nprobe": 10}}
+        search_params = {"metric_type": "IP", "params": {"ef": max(ef, limit)}}
         
         try:
             results = self.collection.search(
                 data=[user_vector],
                 anns_field="embeddings",
                 param=search_params,
-                limit=10,
+                limit=limit,
                 output_fields=["text_segment"]
             )
             print(f"Milvus 检索结果: {results}")
@@ -91,11 +131,59 @@ class Pipeline:
             print(f"Milvus 检索失败: {e}")
             return []
 
+    def build_messages(self, body: dict, user_message: str, contexts: List[str]):
+        combined_message = self.combine_user_message_with_context(user_message, contexts)
+        # valves 中的 prompt 固定作为 system 消息放在最前面，保持请求前缀不变以复用模型的 KV 缓存
+        body['messages'] = [
+            {"role": "system", "content": self.valves.PROMPT},
+            {"role": "user", "content": combined_message}
+        ]
+
+    def widen_retrieval(self, body: dict, user_message: str, retry_count: int):
+        # 回答未通过校验多半是检索不充分：每次重试扩大候选数和 HNSW 搜索宽度，而不是重复相同的检索
+        limit = 10 * (retry_count + 1)
+        ef = min(64 * 4 ** retry_count, 4096)
+        print(f"扩大检索范围: limit={limit}, ef={ef}")
+        retrieved_contexts = self.retrieve_relevant_information(user_message, limit, ef)
+        self.build_messages(body, user_message, retrieved_contexts)
+
+    def is_repeated_answer(self, generated_answer: str, seen_answers: set) -> bool:
+        # 扩大检索后回答仍与之前某次完全相同，继续重试也无济于事
+        answer_hash = hashlib.sha256(generated_answer.encode("utf-8")).hexdigest()
+        if answer_hash in seen_answers:
+            print("重新生成的回答与之前相同，停止重试")
+            return True
+        seen_answers.add(answer_hash)
+        return False
+
     def combine_user_message_with_context(self, user_message: str, contexts: List[str]) -> str:
-        combined_message = self.valves.PROMPT + "\n\n" + "这是用户问题：" + "\n\n"  + user_message + "\n\n" + "这是你学习的内容，回答时请不要提及从此获取的信息：" + "\n".join(contexts)
+        combined_message = "这是用户问题：" + "\n\n"  + user_message + "\n\n" + "这是你学习的内容，回答时请不要提及从此获取的信息：" + "\n".join(contexts)
         return combined_message
     
+    def load_judge(self):
+        # 使用本地 cross-encoder 判断回答是否合格，判断耗时从秒级降到毫秒级；加载失败时退回 LLM 判断
+        if not self.valves.SUPERVISION_MODEL:
+            return
+        try:
+            from sentence_transformers import CrossEncoder
+            self.judge = CrossEncoder(self.valves.SUPERVISION_MODEL)
+        except Exception as e:
+            print(f"监督模型加载失败，改用 LLM 判断: {e}")
+            self.judge = None
+
     def supervise_answer(self, user_message: str, generated_answer: str) -> bool:
+        if self.judge is None:
+            return self.supervise_answer_with_llm(user_message, generated_answer)
+
+        try:
+            score = float(self.judge.predict([(user_message, generated_answer)])[0])
+            print(f"监督模型得分: {score:.3f}")
+            return score > self.valves.SUPERVISION_THRESHOLD
+        except Exception as e:
+            print(f"监督模型调用出错: {e}")
+            return False
+
+    def supervise_answer_with_llm(self, user_message: str, generated_answer: str) -> bool:
         try:
             # 组合监督模型的 prompt
             supervision_prompt = (
@@ -105,11 +193,12 @@ class Pipeline:
                 "请判断上述回答是否符合用户问题的要求，并返回'true'或'false',返回示例：“true”。"
             )
             
-            response = requests.post(
-                url=f"{self.valves.OLLAMA_HOST}/v1/completions",
+            response = SESSION.post(
+                url=f"{self.valves.LLM_HOST}/v1/completions",
                 json={
                     "model": self.valves.LLM_MODEL,
-                    "prompt": supervision_prompt
+                    "prompt": supervision_prompt,
+                    "max_tokens": 64  # 只需返回判断结果；OpenAI 兼容服务（如 vLLM）默认只生成 16 个 token
                 }
             )
             
@@ -121,15 +210,78 @@ class Pipeline:
             print(f"监督模型调用出错: {e}")
             return False
 
+    def request_answer(self, body: dict) -> requests.Response:
+        r = SESSION.post(
+            url=f"{self.valves.LLM_HOST}/v1/chat/completions",
+            json={**body, "model": self.valves.LLM_MODEL},
+            stream=True,
+        )
+        r.raise_for_status()
+        return r
+
+    def extract_delta_content(self, line: bytes) -> Union[str, None]:
+        # 解析单个 data 块，返回增量内容；遇到流结束标志时返回 None
+        # 直接在原始字节上匹配前缀并交给 orjson 解析，省去逐行 decode
+        if not line.startswith(b"data: "):
+            return ""
+        json_data = line.removeprefix(b"data: ")
+        if json_data.strip() == b"[DONE]":
+            return None
+        try:
+            chunk = orjson.loads(json_data)  # 转换为 JSON 格式
+            return chunk.get("choices", [{}])[0].get("delta", {}).get("content", "") or ""
+        except orjson.JSONDecodeError as e:
+            print(f"JSON 解析错误: {e}")
+            print(f"原始数据: {json_data.decode('utf-8', errors='replace')}")
+            return ""
+
+    def stream_supervised_answer(self, user_message: str, body: dict, max_retries: int = 5) -> Generator:
+        # 边生成边推送给用户，同时缓存完整回答，生成结束后再交给监督模型校验
+        retry_count = 0
+        seen_answers = set()
+
+        try:
+            while retry_count < max_retries:
+                r = self.request_answer(body)
+
+                generated_answer = ""
+                done_line = b"data: [DONE]"
+
+                for line in r.iter_lines():
+                    if not line:
+                        continue
+                    delta_content = self.extract_delta_content(line)
+                    if delta_content is None:
+                        done_line = line  # 结束标志留到校验通过后再发送
+                        break
+                    generated_answer += delta_content
+                    yield line
+
+                if self.supervise_answer(user_message, generated_answer):
+                    yield done_line
+                    return
+
+                if self.is_repeated_answer(generated_answer, seen_answers):
+                    break
+
+                retry_count += 1
+                print(f"监督模型认为回答不符合要求，重新生成答案... (重试次数: {retry_count})")
+                if retry_count < max_retries:
+                    yield "\n\n（以上回答未通过校验，正在重新生成……）\n\n"
+                    self.widen_retrieval(body, user_message, retry_count)
+
+            yield "正在学习相关知识中，您可以前往官方网站或联系相关管理人员获取您需要的知识。"
+
+        except requests.exceptions.RequestException as e:
+            yield f"请求出错: {e}"
+        except Exception as e:
+            yield f"其他错误: {e}"
+
     def pipe(self, user_message: str, model_id: str, messages: List[dict], body: dict) -> Union[str, Generator, Iterator]:
         print(f"pipe:{__name__}")
         
-        body['messages'] = []  # 清空旧的上下文
-        
         retrieved_contexts = self.retrieve_relevant_information(user_message)
-        combined_message = self.combine_user_message_with_context(user_message, retrieved_contexts)
-        
-        body['messages'].append({"role": "user", "content": combined_message})
+        self.build_messages(body, user_message, retrieved_contexts)
         
         if "user" in body:
             print("######################################")
@@ -137,47 +289,41 @@ class Pipeline:
             print(f"# 消息: {user_message}")
             print("######################################")
         
+        # 流式请求直接返回生成器，首个 token 无需等待监督模型
+        if body.get("stream"):
+            return self.stream_supervised_answer(user_message, body)
+
         retry_count = 0
         max_retries = 5
+        seen_answers = set()
         
         try:
             while retry_count < max_retries:
                 # 生成初步回答
-                r = requests.post(
-                    url=f"{self.valves.OLLAMA_HOST}/v1/chat/completions",
-                    json={**body, "model": self.valves.LLM_MODEL},
-                    stream=True,
-                )
-                
-                r.raise_for_status()
+                r = self.request_answer(body)
                 
                 generated_answer = ""
                 
                 # 处理流式响应
                 for line in r.iter_lines():
                     if line:
-                        line_str = line.decode("utf-8")
-                        if line_str.startswith("data: "):  # 处理每个 data 块
-                            json_data = line_str[len("data: "):]
-                            if json_data.strip() == "[DONE]":  # 处理流结束标志
-                                break
-                            try:
-                                chunk = json.loads(json_data)  # 转换为 JSON 格式
-                                delta_content = chunk.get("choices", [{}])[0].get("delta", {}).get("content", "")
-                                generated_answer += delta_content  # 拼接生成的内容
-                            except json.JSONDecodeError as e:
-                                print(f"JSON 解析错误: {e}")
-                                print(f"原始数据: {json_data}")
-                                continue  # 跳过当前循环，继续处理下一个数据块
+                        delta_content = self.extract_delta_content(line)
+                        if delta_content is None:  # 处理流结束标志
+                            break
+                        generated_answer += delta_content  # 拼接生成的内容
 
                 # 调用监督模型进行验证
                 is_valid = self.supervise_answer(user_message, generated_answer)
                 
                 if is_valid:
                     return generated_answer  # 如果答案符合要求，返回答案
+                elif self.is_repeated_answer(generated_answer, seen_answers):
+                    break
                 else:
                     retry_count += 1
                     print(f"监督模型认为回答不符合要求，重新生成答案... (重试次数: {retry_count})")
+                    if retry_count < max_retries:
+                        self.widen_retrieval(body, user_message, retry_count)
             
             return "正在学习相关知识中，您可以前往官方网站或联系相关管理人员获取您需要的知识。"
         